@@ -0,0 +1,92 @@
+"""API 进程启动基准测试
+
+测量两项指标：
+1. 导入 main 模块的冷启动耗时和进程 RSS（对比同时加载数据分析库的情况，
+   后者在同一进程中调用 load_data_stack()，只是对执行进程开销的估算）
+2. 从启动 uvicorn 到 /health 返回 200 的耗时
+
+用法:
+    python benchmark_startup.py [--runs 5] [--port 8765]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 在子进程中执行，输出: 导入耗时(s) RSS(KB) 是否加载了 pandas
+IMPORT_PROBE = """
+import resource, sys, time
+start = time.perf_counter()
+import main
+if {load_data_stack}:
+    main.load_data_stack()
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(elapsed, rss, 'pandas' in sys.modules)
+"""
+
+
+def measure_import(load_data_stack: bool, runs: int):
+    """多次在全新进程中导入 main，返回 (平均耗时, 平均 RSS KB, 是否加载了 pandas)"""
+    timings, rss_values, pandas_loaded = [], [], False
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_PROBE.format(load_data_stack=load_data_stack)],
+            cwd=BACKEND_DIR,
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.split()
+        timings.append(float(output[0]))
+        rss_values.append(int(output[1]))
+        pandas_loaded = output[2] == "True"
+    return sum(timings) / runs, sum(rss_values) / runs, pandas_loaded
+
+
+def measure_time_to_healthy(port: int, timeout: float = 60.0) -> float:
+    """启动 uvicorn 并轮询 /health，返回首次返回 200 的耗时"""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=BACKEND_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.05)
+        raise TimeoutError(f"/health 在 {timeout}s 内未就绪")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API 进程启动基准测试")
+    parser.add_argument("--runs", type=int, default=5, help="每项测量的重复次数")
+    parser.add_argument("--port", type=int, default=8765, help="uvicorn 测试端口")
+    args = parser.parse_args()
+
+    api_time, api_rss, api_pandas = measure_import(False, args.runs)
+    full_time, full_rss, _ = measure_import(True, args.runs)
+
+    print(f"{'场景':<24}{'导入耗时 (s)':>14}{'RSS (MB)':>12}")
+    print(f"{'API 进程 (import main)':<24}{api_time:>14.3f}{api_rss / 1024:>12.1f}")
+    print(f"{'+ 数据分析库 (估算)':<24}{full_time:>14.3f}{full_rss / 1024:>12.1f}")
+    print(f"API 进程加载了 pandas: {api_pandas}")
+
+    healthy_times = [measure_time_to_healthy(args.port) for _ in range(args.runs)]
+    print(f"uvicorn 启动到 /health 就绪: {sum(healthy_times) / len(healthy_times):.3f}s (平均 {args.runs} 次)")
+
+
+if __name__ == "__main__":
+    main()
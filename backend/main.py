@@ -1,9 +1,14 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, AsyncIterator, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
 import os
 import httpx
 import json
@@ -11,16 +16,30 @@ import io
 import sys
 import traceback
 import re
-import glob
 import uuid
+import time
+import ast
+import cProfile
+import pstats
+import tracemalloc
+import functools
+import hashlib
+import gzip
+import mimetypes
 from datetime import datetime
-import pandas as pd
-import pdfplumber
-import numpy as np
-import matplotlib
-matplotlib.use('Agg')  # 使用非交互式后端
-import matplotlib.pyplot as plt
-import seaborn as sns
+
+try:
+    import brotli  # 可选：为文本类产物生成 brotli 预压缩版本
+except ImportError:
+    brotli = None
+
+# 数据分析库只在代码执行进程中按需加载（见 load_data_stack），API 进程只依赖 FastAPI/httpx，启动更快、内存更小
+pd = None
+np = None
+matplotlib = None
+plt = None
+sns = None
+pdfplumber = None
 
 app = FastAPI(title="CloudOS AI Backend")
 
@@ -36,11 +55,98 @@ app.add_middleware(
 # 确保上传目录存在
 UPLOAD_DIR = "/app/uploads"
 STATIC_DIR = "/app/static"
+COLUMNAR_CACHE_DIR = "/app/cache"  # 上传文件的 Parquet 列式缓存，供 SQL 查询使用
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(STATIC_DIR, exist_ok=True)
+os.makedirs(COLUMNAR_CACHE_DIR, exist_ok=True)
+
+# 生成的产物（图片、HTML 报告）按内容哈希命名，内容不变则 URL 不变，可以长期缓存
+ARTIFACT_HASH_LENGTH = 16
+ARTIFACT_NAME_PATTERN = re.compile(r'([0-9a-f]{%d})\.[a-z0-9]+' % ARTIFACT_HASH_LENGTH)
+PRECOMPRESSED_EXTENSIONS = {'.svg', '.html'}  # 生成 gzip/brotli 预压缩版本的产物类型
+HTML_BLOCK_PATTERN = re.compile(r'```html(?!\w)\s*(.*?)```', re.DOTALL | re.IGNORECASE)
+HTML_REPORT_LINK_PATTERN = re.compile(r'!\[HTML 报告\]\(/static/([0-9a-f]{%d}\.html)\)' % ARTIFACT_HASH_LENGTH)
+
+
+class ArtifactStaticFiles(StaticFiles):
+    """静态文件服务：内容哈希命名的产物返回 immutable 缓存头和基于哈希的 ETag，并优先返回预压缩版本"""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        filename = os.path.basename(full_path)
+        match = ARTIFACT_NAME_PATTERN.fullmatch(filename)
+        if not match:
+            return super().file_response(full_path, stat_result, scope, status_code)
+        
+        request_headers = Headers(scope=scope)
+        accepted_encodings = {
+            part.split(';')[0].strip().lower()
+            for part in request_headers.get('accept-encoding', '').split(',')
+        }
+        headers = {
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "ETag": f'"{match.group(1)}"',
+            "Vary": "Accept-Encoding",
+        }
+        path = full_path
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if encoding in accepted_encodings and os.path.exists(full_path + suffix):
+                path = full_path + suffix
+                stat_result = os.stat(path)
+                headers["Content-Encoding"] = encoding
+                headers["ETag"] = f'"{match.group(1)}-{encoding}"'
+                break
+        
+        response = FileResponse(
+            path,
+            status_code=status_code,
+            headers=headers,
+            media_type=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+            stat_result=stat_result,
+            method=scope["method"]
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
 
 # 添加静态文件服务
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+app.mount("/static", ArtifactStaticFiles(directory=STATIC_DIR), name="static")
+
+# 代码执行进程池 - 代码在独立进程中执行，不阻塞 API 事件循环
+SANDBOX_WORKERS = int(os.getenv("SANDBOX_WORKERS", "2"))
+_sandbox_pool: Optional[ProcessPoolExecutor] = None
+
+# 匹配 ```python ... ``` 格式的代码块
+CODE_BLOCK_PATTERN = re.compile(r'```python\s*\n(.*?)```', re.DOTALL)
+
+# SQL 查询最多返回的行数
+SQL_MAX_ROWS = 1000
+EXCEL_EXTENSIONS = ('.xlsx', '.xls')
+
+# SQL 快速查询线程池 - 与代码执行进程池分开，避免毫秒级查询排在耗时的分析任务后面（DuckDB 执行时释放 GIL）
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", "4"))
+_query_executor: Optional[ThreadPoolExecutor] = None
+
+# 快速查询路由 - 可以直接翻译成 SQL 的简单问题（匹配前会去掉问句前缀和结尾的标点）
+QUESTION_PREFIX_PATTERN = re.compile(r"^(?:what(?:'s| is| are)|show(?: me)?|give me|compute|calculate|list|请问|请)\s*(?:the\s+)?", re.IGNORECASE)
+COUNT_QUESTION_PATTERN = re.compile(
+    r"(?:how many (?:rows|records)(?: are)?(?: there)?(?: in (?:the |this )?(?:file|data|dataset|table))?"
+    r"|(?:row|record) count|number of (?:rows|records)"
+    r"|(?:一共|总共)?(?:有)?多少(?:行|条)(?:数据|记录)?|行数|记录数)",
+    re.IGNORECASE
+)
+AGGREGATE_QUESTION_PATTERN = re.compile(
+    r"(average|avg|mean|sum|total|max|maximum|min|minimum)\s+(?:of\s+)?(?:the\s+)?([\w.]+)"
+    r"(?:\s+(?:by|per|for each|grouped by)\s+([\w.]+))?",
+    re.IGNORECASE
+)
+TOP_QUESTION_PATTERN = re.compile(r"top\s+(\d+)(?:\s+[\w.]+)?\s+by\s+([\w.]+)", re.IGNORECASE)
+AGGREGATE_FUNCTIONS = {
+    'average': 'AVG', 'avg': 'AVG', 'mean': 'AVG',
+    'sum': 'SUM', 'total': 'SUM',
+    'max': 'MAX', 'maximum': 'MAX',
+    'min': 'MIN', 'minimum': 'MIN',
+}
 
 # 系统提示词 - 告诉大模型可以使用代码执行功能
 SYSTEM_INSTRUCTION = """You are Athlon Agent, an AI assistant with code execution capabilities - similar to OpenAI Code Interpreter.
@@ -62,6 +168,7 @@ IMPORTANT CAPABILITIES:
 
 AVAILABLE LIBRARIES:
 - The following libraries are pre-loaded: pandas (pd), numpy (np), matplotlib.pyplot (plt), seaborn (sns), json, pdfplumber
+- `sql(query)` runs a read-only SQL (DuckDB) SELECT over all uploaded CSV/Excel/Parquet files and returns a DataFrame. Each file is a table named after the file name without extension, with non-alphanumeric characters replaced by `_` (e.g. `sales-2024.csv` -> `sales_2024`; if two files share a name the extension is kept, e.g. `sales_csv`, and the exact table name is given with each uploaded file). Prefer it for filtering, grouping and aggregation of large files
 - You can also import: datetime, math, statistics, etc.
 - Dangerous modules (os, sys, subprocess) are restricted
 
@@ -81,6 +188,16 @@ RESPONSE FORMAT:
 - Charts and plots appear automatically - just use plt.show() or plt.savefig()
 - For HTML reports: Output HTML directly in ```html ... ``` blocks, do NOT use Python to generate HTML"""
 
+# 批量分析提示词 - 要求大模型生成与具体文件无关的通用脚本
+BATCH_INSTRUCTION = """
+
+BATCH MODE:
+- The same script will be executed once for EACH uploaded file listed by the user, in parallel
+- The variable `file_path` holds the path of the file currently being processed - ALWAYS read data from `file_path`
+- **DO NOT** hardcode any file name or path, and do not loop over multiple files yourself
+- Assume all files share the same structure as the sample file
+- Keep printed output concise, and make the LAST printed line a one-line key result for this file (it is shown in the combined summary table)"""
+
 
 class ChatMessage(BaseModel):
     role: str
@@ -92,6 +209,18 @@ class ChatRequest(BaseModel):
     filename: Optional[str] = None
 
 
+class BatchRequest(BaseModel):
+    prompt: str
+    filenames: List[str]
+    max_concurrency: Optional[int] = None
+
+
+class QueryRequest(BaseModel):
+    sql: str
+    filenames: Optional[List[str]] = None  # 默认查询所有上传文件
+    limit: int = SQL_MAX_ROWS
+
+
 def safe_import(name, globals=None, locals=None, fromlist=(), level=0):
     """安全的导入函数，只允许导入白名单中的模块"""
     # 允许导入的安全模块白名单
@@ -117,8 +246,11 @@ def safe_import(name, globals=None, locals=None, fromlist=(), level=0):
     raise ImportError(f"Import of '{name}' is not allowed. Only safe modules can be imported. Allowed modules include: pandas, numpy, matplotlib, seaborn, json, etc.")
 
 
-def execute_python_code(code: str, file_path: Optional[str] = None, safe_globals: Dict = None, safe_locals: Dict = None) -> Dict[str, Any]:
-    """执行 Python 代码并返回结果"""
+def execute_python_code(code: str, file_path: Optional[str] = None, safe_globals: Dict = None, safe_locals: Dict = None, profile: bool = False) -> Dict[str, Any]:
+    """执行 Python 代码并返回结果
+
+    profile=True 时额外收集 cProfile 热点、tracemalloc 内存峰值和 pandas 反模式，放在结果的 "profile" 字段中。
+    """
     # 安全检查：禁止危险的导入和操作（使用更精确的匹配）
     dangerous_patterns = [
         (r'\bimport\s+os\b', 'import os'),
@@ -188,13 +320,7 @@ def execute_python_code(code: str, file_path: Optional[str] = None, safe_globals
                 "traceback": None
             }
     
-    # 记录执行前的图片文件列表（用于检测新生成的图片）
-    existing_images = set()
-    if os.path.exists(STATIC_DIR):
-        existing_images = set(glob.glob(os.path.join(STATIC_DIR, "*.png")) + 
-                             glob.glob(os.path.join(STATIC_DIR, "*.jpg")) +
-                             glob.glob(os.path.join(STATIC_DIR, "*.jpeg")) +
-                             glob.glob(os.path.join(STATIC_DIR, "*.svg")))
+    load_data_stack()
     
     # 创建 matplotlib 包装器，自动保存图片
     class MatplotlibWrapper:
@@ -229,9 +355,10 @@ def execute_python_code(code: str, file_path: Optional[str] = None, safe_globals
                 unique_id = str(uuid.uuid4())[:8]
                 filename = f"plot_{timestamp}_{unique_id}.png"
             
-            # 如果不是绝对路径，保存到 static 目录
+            # 如果不是绝对路径，保存到 static 目录（加唯一前缀，避免并行执行的代码使用同名文件互相覆盖，之后会按内容哈希重命名）
             if not os.path.isabs(filename):
-                filename = os.path.join(self.static_dir, filename)
+                unique_id = str(uuid.uuid4())[:8]
+                filename = os.path.join(self.static_dir, f"{unique_id}_{os.path.basename(filename)}")
             
             # 确保目录存在
             os.makedirs(os.path.dirname(filename), exist_ok=True)
@@ -287,6 +414,7 @@ def execute_python_code(code: str, file_path: Optional[str] = None, safe_globals
             'sns': sns,
             'seaborn': sns,
             'display': lambda x: print(str(x)),  # 简单的 display 函数
+            'sql': sql,  # 在上传文件上执行 SQL 查询
         }
         
         # 如果提供了文件路径，添加到环境
@@ -315,6 +443,8 @@ def execute_python_code(code: str, file_path: Optional[str] = None, safe_globals
             safe_globals['seaborn'] = sns
         if 'display' not in safe_globals:
             safe_globals['display'] = lambda x: print(str(x))
+        if 'sql' not in safe_globals:
+            safe_globals['sql'] = sql
         if file_path and 'file_path' not in safe_globals:
             safe_globals['file_path'] = file_path
     
@@ -327,46 +457,28 @@ def execute_python_code(code: str, file_path: Optional[str] = None, safe_globals
     old_stdout = sys.stdout
     sys.stdout = captured_output = io.StringIO()
     
+    # 性能分析（可选）
+    profiler = cProfile.Profile() if profile else None
+    peak_memory = 0
+    if profile:
+        tracemalloc.start()
+    start_time = time.perf_counter()
+    
     try:
-        exec(code, safe_globals, safe_locals)
+        if profiler:
+            profiler.enable()
+        try:
+            exec(code, safe_globals, safe_locals)
+        finally:
+            duration = time.perf_counter() - start_time
+            if profiler:
+                profiler.disable()
+                _, peak_memory = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
         output = captured_output.getvalue()
         
-        # 检测新生成的图片文件
-        new_images = []
-        if os.path.exists(STATIC_DIR):
-            current_images = set(glob.glob(os.path.join(STATIC_DIR, "*.png")) + 
-                                glob.glob(os.path.join(STATIC_DIR, "*.jpg")) +
-                                glob.glob(os.path.join(STATIC_DIR, "*.jpeg")) +
-                                glob.glob(os.path.join(STATIC_DIR, "*.svg")))
-            
-            new_images = list(current_images - existing_images)
-            
-            # 添加包装器保存的图片（可能不在 glob 中）
-            for img_path in wrapped_plt._saved_images:
-                if os.path.exists(img_path) and img_path not in new_images:
-                    new_images.append(img_path)
-            
-            # 按修改时间排序，最新的在前
-            new_images.sort(key=lambda x: os.path.getmtime(x) if os.path.exists(x) else 0, reverse=True)
-        
-        # 如果代码执行后还有打开的图形（可能调用了 plt.show() 但没有保存），自动保存
-        if len(plt.get_fignums()) > 0:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            unique_id = str(uuid.uuid4())[:8]
-            auto_filename = os.path.join(STATIC_DIR, f"plot_{timestamp}_{unique_id}.png")
-            plt.savefig(auto_filename, dpi=100, bbox_inches='tight')
-            plt.close('all')
-            if auto_filename not in new_images:
-                new_images.append(auto_filename)
-        
-        # 将图片路径转换为 URL
-        image_urls = []
-        for img_path in new_images:
-            if os.path.exists(img_path):
-                filename = os.path.basename(img_path)
-                image_urls.append(f"/static/{filename}")
-        
         # 获取最后一个表达式的结果（如果有）
+        # 先于图片检测执行，求值时重新保存的图片也会按内容哈希处理
         result = None
         if code.strip():
             try:
@@ -389,12 +501,39 @@ def execute_python_code(code: str, file_path: Optional[str] = None, safe_globals
             except:
                 pass
         
-        return {
+        # 只收集本次执行通过包装器保存的图片（多个执行进程共用 static 目录，不能按目录前后差异判断）
+        new_images = []
+        for img_path in wrapped_plt._saved_images:
+            if os.path.exists(img_path) and img_path not in new_images:
+                new_images.append(img_path)
+        
+        # 如果代码执行后还有打开的图形（可能调用了 plt.show() 但没有保存），自动保存
+        if len(plt.get_fignums()) > 0:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            unique_id = str(uuid.uuid4())[:8]
+            auto_filename = os.path.join(STATIC_DIR, f"plot_{timestamp}_{unique_id}.png")
+            plt.savefig(auto_filename, dpi=100, bbox_inches='tight')
+            plt.close('all')
+            if auto_filename not in new_images:
+                new_images.append(auto_filename)
+        
+        # 将图片按内容哈希命名并转换为 URL（内容相同的图片只保存一份）
+        image_urls = []
+        for img_path in new_images:
+            url = store_artifact(img_path)
+            if url and url not in image_urls:
+                image_urls.append(url)
+        
+        execution_result = {
             "success": True,
             "output": output,
             "result": str(result) if result is not None else None,
-            "images": image_urls  # 返回图片 URL 列表
+            "images": image_urls,  # 返回图片 URL 列表
+            "duration": duration
         }
+        if profiler:
+            execution_result["profile"] = build_profile_summary(profiler, peak_memory, duration, code)
+        return execution_result
     except Exception as e:
         # 确保关闭所有打开的图形
         plt.close('all')
@@ -410,14 +549,842 @@ def execute_python_code(code: str, file_path: Optional[str] = None, safe_globals
         plt.close('all')
 
 
+class PandasAntiPatternVisitor(ast.NodeVisitor):
+    """通过 AST 检查常见的 pandas 低效写法"""
+
+    READ_FUNCTIONS = {'read_csv', 'read_excel', 'read_json', 'read_parquet', 'read_table'}
+
+    def __init__(self):
+        self.findings: List[str] = []
+        self._loop_depth = 0
+
+    def _visit_loop(self, node):
+        self._loop_depth += 1
+        self.generic_visit(node)
+        self._loop_depth -= 1
+
+    visit_For = _visit_loop
+    visit_While = _visit_loop
+    visit_ListComp = _visit_loop
+    visit_DictComp = _visit_loop
+    visit_GeneratorExp = _visit_loop
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Attribute):
+            name = node.func.attr
+            if name in ('iterrows', 'itertuples'):
+                self.findings.append(f"第 {node.lineno} 行: 使用 .{name}() 逐行遍历 DataFrame，应改为向量化的列运算")
+            elif name == 'apply' and any(
+                keyword.arg == 'axis' and isinstance(keyword.value, ast.Constant) and keyword.value.value in (1, 'columns')
+                for keyword in node.keywords
+            ):
+                self.findings.append(f"第 {node.lineno} 行: 使用 .apply(axis=1) 按行调用 Python 函数，应改为向量化的列运算或 np.where/np.select")
+            elif self._loop_depth and name in self.READ_FUNCTIONS:
+                self.findings.append(f"第 {node.lineno} 行: 在循环中调用 {name}() 重复读取文件，应在循环外只读取一次")
+            elif self._loop_depth and name == 'concat':
+                self.findings.append(f"第 {node.lineno} 行: 在循环中调用 concat() 逐步拼接 DataFrame（平方级复制），应先收集到列表再一次性拼接")
+        self.generic_visit(node)
+
+
+def detect_pandas_anti_patterns(code: str) -> List[str]:
+    """返回代码中检测到的 pandas 反模式描述"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return []
+    visitor = PandasAntiPatternVisitor()
+    visitor.visit(tree)
+    return visitor.findings
+
+
+def build_profile_summary(profiler: cProfile.Profile, peak_memory: int, duration: float, code: str, top: int = 15) -> Dict[str, Any]:
+    """汇总 cProfile 热点、内存峰值和 pandas 反模式"""
+    stats_output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stats_output)
+    stats.sort_stats('cumulative').print_stats(top)
+    # 去掉 pstats 输出开头的统计说明，只保留函数表
+    hotspots = stats_output.getvalue()
+    table_start = hotspots.find('ncalls')
+    if table_start >= 0:
+        hotspots = hotspots[table_start:]
+    return {
+        "duration": duration,
+        "peak_memory_mb": round(peak_memory / 1024 / 1024, 2),
+        "hotspots": hotspots.strip(),
+        "anti_patterns": detect_pandas_anti_patterns(code)
+    }
+
+
+def _sanitize_table_name(name: str) -> str:
+    """非字母数字字符替换为 _"""
+    return re.sub(r'\W+', '_', name).strip('_') or 'data'
+
+
+def sql_table_names() -> Dict[str, str]:
+    """所有上传文件在 SQL 中对应的表名 {文件名: 表名}
+
+    表名为去掉扩展名的文件名（非字母数字字符替换为 _）；多个文件同名时（如 sales.csv 和 sales.xlsx）
+    改用带扩展名的文件名（sales_csv、sales_xlsx），仍然冲突则追加序号。表名比较不区分大小写，与 DuckDB 一致。
+    """
+    filenames = sorted(f for f in os.listdir(UPLOAD_DIR) if os.path.isfile(os.path.join(UPLOAD_DIR, f)))
+    stems = [_sanitize_table_name(os.path.splitext(filename)[0]) for filename in filenames]
+    stem_counts = {}
+    for stem in stems:
+        stem_counts[stem.lower()] = stem_counts.get(stem.lower(), 0) + 1
+    
+    names = {}
+    used = set()
+    for filename, stem in zip(filenames, stems):
+        table = stem if stem_counts[stem.lower()] == 1 else _sanitize_table_name(filename)
+        candidate, index = table, 2
+        while candidate.lower() in used:
+            candidate = f"{table}_{index}"
+            index += 1
+        used.add(candidate.lower())
+        names[filename] = candidate
+    return names
+
+
+def sql_table_name(filename: str) -> str:
+    """上传文件在 SQL 中对应的表名"""
+    filename = os.path.basename(filename)
+    return sql_table_names().get(filename) or _sanitize_table_name(os.path.splitext(filename)[0])
+
+
+def _sql_literal(value: str) -> str:
+    """转义为 SQL 字符串字面量"""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _sql_identifier(name: str) -> str:
+    """转义为 SQL 标识符"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _columnar_cache_path(file_path: str) -> str:
+    """上传文件对应的 Parquet 列式缓存路径"""
+    return os.path.join(COLUMNAR_CACHE_DIR, os.path.basename(file_path) + '.parquet')
+
+
+def _columnar_copy_is_fresh(file_path: str) -> bool:
+    """列式缓存存在且不早于源文件"""
+    cache_path = _columnar_cache_path(file_path)
+    return os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file_path)
+
+
+def get_columnar_copy(file_path: str, convert_excel: bool = True) -> Optional[str]:
+    """返回上传文件的 Parquet 列式缓存路径（源文件更新后自动重建），不支持的格式返回 None
+
+    Excel 需要 pandas 读取，convert_excel=False 时（API 进程中）只使用已有的缓存，不重建。
+    """
+    import duckdb
+    
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.parquet':
+        return file_path
+    if ext not in ('.csv', '.tsv', '.txt') + EXCEL_EXTENSIONS:
+        return None
+    
+    cache_path = _columnar_cache_path(file_path)
+    if _columnar_copy_is_fresh(file_path):
+        return cache_path
+    if ext in EXCEL_EXTENSIONS and not convert_excel:
+        return None
+    
+    # 先写临时文件再原子替换，避免并发查询读到写了一半的缓存（同一进程的多个查询线程也可能同时转换同一文件）
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+    con = duckdb.connect()
+    try:
+        if ext in EXCEL_EXTENSIONS:
+            load_data_stack()
+            source_df = pd.read_excel(file_path)
+            con.register('source_df', source_df)
+            con.execute(f"COPY (SELECT * FROM source_df) TO {_sql_literal(tmp_path)} (FORMAT PARQUET)")
+        else:
+            # 与 pandas 默认的缺失值标记保持一致，避免含 NA 的数值列被识别为字符串
+            con.execute(f"COPY (SELECT * FROM read_csv_auto({_sql_literal(file_path)}, nullstr=['', 'NA', 'N/A', 'NaN', 'null'])) TO {_sql_literal(tmp_path)} (FORMAT PARQUET)")
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"[SQL] 无法为 {os.path.basename(file_path)} 生成列式缓存: {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    finally:
+        con.close()
+    return cache_path
+
+
+def _referenced_table_names(con, query: str) -> Optional[set]:
+    """只解析不执行，返回查询中引用的表名（小写）；无法解析时返回 None"""
+    # json_serialize_sql 只做语法解析，不会绑定表函数或读取文件
+    parsed = json.loads(con.execute(f"SELECT json_serialize_sql({_sql_literal(query)})").fetchone()[0])
+    if parsed.get("error"):
+        return None
+    
+    names = set()
+    def walk(node):
+        if isinstance(node, dict):
+            if node.get("type") == "BASE_TABLE" and node.get("table_name"):
+                names.add(node["table_name"].lower())
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+    walk(parsed)
+    return names
+
+
+def open_sql_connection(filenames: Optional[List[str]] = None, query: Optional[str] = None, convert_excel: bool = True):
+    """创建内存中的 DuckDB 连接，把上传文件注册为视图（表名见 sql_table_names）
+
+    视图基于 Parquet 列式缓存，查询时只读取需要的列和行组（投影/谓词下推）。
+    提供 query 时只注册查询中引用的表，未引用的文件不会生成列式缓存。
+    连接禁止访问上传目录和缓存目录以外的文件。返回 (连接, {表名: 文件名})。
+    """
+    import duckdb
+    
+    table_names = sql_table_names()
+    if filenames is None:
+        filenames = list(table_names)
+    
+    con = duckdb.connect()
+    allowed = ", ".join(_sql_literal(os.path.join(d, '')) for d in (UPLOAD_DIR, COLUMNAR_CACHE_DIR))
+    con.execute(f"SET allowed_directories = [{allowed}]")
+    con.execute("SET enable_external_access = false")
+    con.execute("SET lock_configuration = true")
+    
+    referenced = _referenced_table_names(con, query) if query is not None else None
+    tables = {}
+    for filename in filenames:
+        filename = os.path.basename(filename)
+        table = table_names.get(filename)
+        if table is None or (referenced is not None and table.lower() not in referenced):
+            continue
+        columnar_path = get_columnar_copy(os.path.join(UPLOAD_DIR, filename), convert_excel)
+        if columnar_path is None:
+            continue
+        con.execute(f"CREATE VIEW {_sql_identifier(table)} AS SELECT * FROM read_parquet({_sql_literal(columnar_path)})")
+        tables[table] = filename
+    return con, tables
+
+
+def _ensure_single_select(con, query: str):
+    """只允许执行单条 SELECT 查询"""
+    import duckdb
+    
+    statements = con.extract_statements(query)
+    if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+        raise ValueError("只允许执行单条 SELECT 查询")
+
+
+def _select_dataframe(con, query: str):
+    """执行单条只读 SELECT 查询并返回 DataFrame"""
+    _ensure_single_select(con, query)
+    return con.sql(query).df()
+
+
+def _json_value(value):
+    """把查询结果中的值转换为可 JSON 序列化的值（NaN 转为 None，日期、Decimal 等转为字符串）"""
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        return None if value != value else value
+    return str(value)
+
+
+def _fetch_payload(con, query: str, limit: int) -> Dict[str, Any]:
+    """执行单条只读 SELECT 查询，返回可 JSON 序列化的列/行结构（最多 limit 行，不依赖 pandas）"""
+    _ensure_single_select(con, query)
+    relation = con.sql(query).limit(limit + 1)
+    rows = relation.fetchall()
+    return {
+        "columns": relation.columns,
+        "rows": [[_json_value(value) for value in row] for row in rows[:limit]],
+        "truncated": len(rows) > limit
+    }
+
+
+def sql(query: str):
+    """在所有上传文件上执行 SQL 查询并返回 DataFrame（供执行环境中的代码调用）"""
+    con, _ = open_sql_connection(query=query)
+    try:
+        return _select_dataframe(con, query)
+    finally:
+        con.close()
+
+
+def referenced_uploads(query: str, filenames: Optional[List[str]] = None) -> List[str]:
+    """返回查询中引用的上传文件名（无法解析时返回全部候选文件）"""
+    import duckdb
+    
+    table_names = sql_table_names()
+    con = duckdb.connect()
+    try:
+        referenced = _referenced_table_names(con, query)
+    finally:
+        con.close()
+    candidates = [os.path.basename(f) for f in filenames] if filenames is not None else list(table_names)
+    return [f for f in candidates if referenced is None or table_names.get(f, '').lower() in referenced]
+
+
+def run_sql_query(query: str, filenames: Optional[List[str]] = None, limit: int = SQL_MAX_ROWS) -> Dict[str, Any]:
+    """在上传文件上执行只读 SQL 查询（在查询线程池中运行，Excel 缓存需事先由 prepare_excel_copies 生成）"""
+    start = time.perf_counter()
+    try:
+        con, tables = open_sql_connection(filenames, query, convert_excel=False)
+        try:
+            payload = _fetch_payload(con, query, limit)
+        finally:
+            con.close()
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+    
+    return {
+        "success": True,
+        "sql": query,
+        "tables": tables,
+        **payload,
+        "duration": time.perf_counter() - start
+    }
+
+
+def match_structured_question(question: str) -> Optional[Dict[str, Any]]:
+    """判断问题是否可以直接翻译成 SQL（行数、分组聚合、Top N），返回查询描述或 None"""
+    text = question.strip().rstrip('?？。.!！ ')
+    text = QUESTION_PREFIX_PATTERN.sub('', text).strip()
+    
+    if COUNT_QUESTION_PATTERN.fullmatch(text):
+        return {"kind": "count"}
+    
+    match = AGGREGATE_QUESTION_PATTERN.fullmatch(text)
+    if match:
+        return {
+            "kind": "aggregate",
+            "function": AGGREGATE_FUNCTIONS[match.group(1).lower()],
+            "column": match.group(2),
+            "group_by": match.group(3)
+        }
+    
+    match = TOP_QUESTION_PATTERN.fullmatch(text)
+    if match:
+        return {"kind": "top", "n": int(match.group(1)), "column": match.group(2)}
+    
+    return None
+
+
+def answer_structured_question(spec: Dict[str, Any], filename: str, limit: int = SQL_MAX_ROWS) -> Dict[str, Any]:
+    """把 match_structured_question 的查询描述翻译成 SQL 并执行（在查询线程池中运行）
+
+    问题中的列名不区分大小写，并忽略空格、点和下划线；无法对应到列时返回失败，由调用方回退到 LLM。
+    """
+    start = time.perf_counter()
+    try:
+        con, tables = open_sql_connection([filename], convert_excel=False)
+        try:
+            if not tables:
+                return {"success": False, "error": "文件不支持 SQL 查询"}
+            table = next(iter(tables))
+            columns = [row[0] for row in con.execute(f"DESCRIBE {_sql_identifier(table)}").fetchall()]
+            normalized_columns = {re.sub(r'[\W_]+', '', column).lower(): column for column in columns}
+            
+            def resolve(name: str) -> str:
+                column = normalized_columns.get(re.sub(r'[\W_]+', '', name).lower())
+                if column is None:
+                    raise KeyError(f"找不到列: {name}")
+                return _sql_identifier(column)
+            
+            source = _sql_identifier(table)
+            if spec["kind"] == "count":
+                query = f"SELECT COUNT(*) AS row_count FROM {source}"
+            elif spec["kind"] == "aggregate":
+                value = resolve(spec["column"])
+                alias = _sql_identifier(f"{spec['function'].lower()}_{spec['column']}")
+                if spec.get("group_by"):
+                    key = resolve(spec["group_by"])
+                    query = f"SELECT {key}, {spec['function']}({value}) AS {alias} FROM {source} GROUP BY {key} ORDER BY {key}"
+                else:
+                    query = f"SELECT {spec['function']}({value}) AS {alias} FROM {source}"
+            elif spec["kind"] == "top":
+                query = f"SELECT * FROM {source} ORDER BY {resolve(spec['column'])} DESC NULLS LAST LIMIT {int(spec['n'])}"
+            else:
+                return {"success": False, "error": f"不支持的查询类型: {spec['kind']}"}
+            
+            payload = _fetch_payload(con, query, limit)
+        finally:
+            con.close()
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+    
+    return {
+        "success": True,
+        "sql": query,
+        "tables": tables,
+        **payload,
+        "duration": time.perf_counter() - start
+    }
+
+
+def format_sql_answer(answer: Dict[str, Any]) -> str:
+    """把快速查询结果格式化为 Markdown 回复"""
+    content = "**快速查询结果**（由 SQL 引擎直接计算，未调用 LLM）\n\n"
+    content += f"```sql\n{answer['sql']}\n```\n\n"
+    content += "| " + " | ".join(str(column) for column in answer["columns"]) + " |\n"
+    content += "| " + " | ".join("---" for _ in answer["columns"]) + " |\n"
+    for row in answer["rows"]:
+        content += "| " + " | ".join("" if value is None else str(value).replace("|", "\\|") for value in row) + " |\n"
+    if answer.get("truncated"):
+        content += f"\n（仅显示前 {len(answer['rows'])} 行）\n"
+    return content
+
+
+def _write_file_atomic(path: str, data: bytes):
+    """先写临时文件再原子替换，避免并发读取到写了一半的文件"""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def store_artifact_bytes(data: bytes, ext: str) -> str:
+    """按内容哈希保存产物并返回 URL，相同内容只保存一份；SVG/HTML 同时生成 gzip/brotli 预压缩版本"""
+    filename = f"{hashlib.sha256(data).hexdigest()[:ARTIFACT_HASH_LENGTH]}{ext.lower()}"
+    target = os.path.join(STATIC_DIR, filename)
+    if not os.path.exists(target):
+        # 先写预压缩版本，产物本身最后写入，保证产物存在时压缩版本也已就绪
+        if ext.lower() in PRECOMPRESSED_EXTENSIONS:
+            _write_file_atomic(target + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                _write_file_atomic(target + '.br', brotli.compress(data, quality=9))
+        _write_file_atomic(target, data)
+    return f"/static/{filename}"
+
+
+def store_artifact(path: str) -> Optional[str]:
+    """把生成的文件按内容哈希保存到 static 目录并返回 URL，static 目录中的原始文件会被删除"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    
+    url = store_artifact_bytes(data, os.path.splitext(path)[1])
+    if os.path.dirname(os.path.abspath(path)) == os.path.abspath(STATIC_DIR) and os.path.basename(path) != os.path.basename(url):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return url
+
+
+def full_html_document(html: str) -> str:
+    """确保 HTML 内容完整（没有 html/head/body 标签时自动包装），与前端 getFullHtml 的规则一致"""
+    trimmed = html.strip()
+    lowered = trimmed.lower()
+    if lowered.startswith('<!doctype') or ('<html' in lowered and '</html>' in lowered):
+        return trimmed
+    if lowered.startswith('<html') or lowered.startswith('<head') or lowered.startswith('<body'):
+        return f'<!DOCTYPE html>\n<html>\n<head><meta charset="UTF-8"></head>\n<body>\n{trimmed}\n</body>\n</html>'
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="UTF-8">
+  <meta name="viewport" content="width=device-width, initial-scale=1.0">
+  <title>HTML Preview</title>
+</head>
+<body>
+{trimmed}
+</body>
+</html>"""
+
+
+def publish_html_reports(content: str) -> str:
+    """把回复中的 ```html 报告补全为完整文档后保存为内容哈希命名的静态文件，回复中只保留链接
+
+    客户端把回复作为对话历史发回时，由 expand_html_reports 按链接还原 HTML 源码。
+    """
+    def replace(match):
+        url = store_artifact_bytes(full_html_document(match.group(1)).encode('utf-8'), '.html')
+        return f"![HTML 报告]({url})"
+    return HTML_BLOCK_PATTERN.sub(replace, content)
+
+
+def expand_html_reports(content: str) -> str:
+    """把对话历史中的 HTML 报告链接还原为 ```html 代码块，后续追问时 LLM 仍能看到报告源码"""
+    def replace(match):
+        try:
+            with open(os.path.join(STATIC_DIR, match.group(1)), encoding='utf-8') as f:
+                return f"```html\n{f.read()}\n```"
+        except FileNotFoundError:
+            return match.group(0)
+    return HTML_REPORT_LINK_PATTERN.sub(replace, content)
+
+
+def load_data_stack():
+    """加载 pandas/numpy/matplotlib 等数据分析库（只在代码执行进程中调用，每个进程只加载一次）"""
+    global pd, np, matplotlib, plt, sns, pdfplumber
+    if pd is not None:
+        return
+    import pandas as pd
+    import numpy as np
+    # 固定 SVG/PDF 中的时间戳和元素 ID，相同的图表生成相同的文件，便于按内容哈希去重
+    os.environ.setdefault('SOURCE_DATE_EPOCH', '0')
+    import matplotlib
+    matplotlib.use('Agg')  # 使用非交互式后端
+    matplotlib.rcParams['svg.hashsalt'] = 'cloudos'
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    import pdfplumber
+
+
+def get_sandbox_pool() -> ProcessPoolExecutor:
+    """获取代码执行进程池（首次使用时创建，进程启动时预加载数据分析库）"""
+    global _sandbox_pool
+    if _sandbox_pool is None:
+        _sandbox_pool = ProcessPoolExecutor(max_workers=SANDBOX_WORKERS, initializer=load_data_stack)
+    return _sandbox_pool
+
+
+def discard_broken_sandbox_pool(pool: ProcessPoolExecutor, error: BaseException) -> Dict[str, Any]:
+    """执行进程异常退出（段错误、被 OOM 杀死等）后进程池无法继续使用，丢弃它以便下次调用时重建
+
+    返回一个普通的执行失败结果，调用方可以像处理代码报错一样继续（例如让 LLM 修复代码）。
+    """
+    global _sandbox_pool
+    print(f"[执行] 执行进程异常退出，重建进程池: {str(error)}")
+    if _sandbox_pool is pool:
+        _sandbox_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+    return {
+        "success": False,
+        "error": "代码执行进程异常退出（可能是内存不足或程序崩溃），请减少一次加载的数据量后重试"
+    }
+
+
+async def run_in_sandbox(func, *args, **kwargs):
+    """在代码执行进程池中运行函数，不阻塞事件循环；执行进程崩溃时返回失败结果并重建进程池"""
+    loop = asyncio.get_running_loop()
+    pool = get_sandbox_pool()
+    try:
+        return await loop.run_in_executor(pool, functools.partial(func, *args, **kwargs))
+    except BrokenProcessPool as e:
+        return discard_broken_sandbox_pool(pool, e)
+
+
+def get_query_executor() -> ThreadPoolExecutor:
+    """获取 SQL 快速查询线程池（首次使用时创建）"""
+    global _query_executor
+    if _query_executor is None:
+        _query_executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="sql-query")
+    return _query_executor
+
+
+async def run_in_query_thread(func, *args, **kwargs):
+    """在 SQL 快速查询线程池中运行函数，不占用代码执行进程"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_query_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """在默认线程池中运行阻塞的文件读写和压缩，不阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+async def prepare_excel_copies(filenames: List[str]):
+    """在代码执行进程中为过期的 Excel 文件生成列式缓存（读取 Excel 需要 pandas，API 进程不加载）"""
+    for filename in filenames:
+        file_path = os.path.join(UPLOAD_DIR, os.path.basename(filename))
+        if os.path.splitext(file_path)[1].lower() in EXCEL_EXTENSIONS and not _columnar_copy_is_fresh(file_path):
+            await run_in_sandbox(get_columnar_copy, file_path)
+
+
 def extract_code_blocks(text: str) -> List[str]:
     """从文本中提取 Python 代码块"""
     # 匹配 ```python ... ``` 格式
-    pattern = r'```python\s*\n(.*?)```'
-    matches = re.findall(pattern, text, re.DOTALL)
+    matches = CODE_BLOCK_PATTERN.findall(text)
     return matches
 
 
+class StreamingCodeBlockParser:
+    """增量解析 LLM 的流式输出，检测已经闭合的 ```python 代码块
+
+    与 extract_code_blocks 使用同一个正则，保证流式解析的结果与整段解析一致。
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.blocks: List[str] = []
+        self._scan_pos = 0  # 上一个已闭合代码块的结束位置
+
+    def feed(self, chunk: str) -> List[str]:
+        """追加一段文本，返回本次新闭合的代码块"""
+        self.buffer += chunk
+        # 代码块只能在出现结束标记 ``` 时闭合，没有反引号的片段无需重新扫描
+        if '`' not in chunk:
+            return []
+
+        new_blocks = []
+        while True:
+            match = CODE_BLOCK_PATTERN.search(self.buffer, self._scan_pos)
+            if not match:
+                break
+            new_blocks.append(match.group(1))
+            self._scan_pos = match.end()
+
+        self.blocks.extend(new_blocks)
+        return new_blocks
+
+
+def build_chat_completions_endpoint(llm_api_base: str) -> str:
+    """根据 LLM_API_BASE 构建 OpenAI 兼容的 chat/completions 地址"""
+    endpoint = llm_api_base.rstrip('/')
+    if endpoint.endswith('/chat/completions'):
+        # 已经包含完整路径
+        pass
+    elif endpoint.endswith('/v1'):
+        # 已经包含 /v1，只需添加 /chat/completions
+        endpoint = endpoint + '/chat/completions'
+    elif '/v1/' in endpoint:
+        # 包含 /v1/，添加 chat/completions
+        endpoint = endpoint.rstrip('/') + '/chat/completions'
+    else:
+        # 不包含 /v1，添加 /v1/chat/completions
+        endpoint = endpoint + '/v1/chat/completions'
+    return endpoint
+
+
+async def stream_llm_completion(
+    client: httpx.AsyncClient,
+    messages: List[Dict[str, str]],
+    llm_api_base: str = None,
+    llm_api_key: str = None,
+    llm_model: str = None,
+    ollama_host: str = None
+) -> AsyncIterator[str]:
+    """以流式方式调用 LLM，逐段产出生成的文本"""
+    if llm_api_base and llm_api_key:
+        # 自定义 LLM API (OpenAI/vLLM 兼容)，返回 SSE 格式: data: {...}
+        endpoint = build_chat_completions_endpoint(llm_api_base)
+        async with client.stream(
+            "POST",
+            endpoint,
+            headers={
+                "Authorization": f"Bearer {llm_api_key}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "model": llm_model,
+                "messages": messages,
+                "stream": True
+            },
+            timeout=60.0
+        ) as response:
+            if response.status_code != 200:
+                body = (await response.aread()).decode("utf-8", errors="replace")
+                print(f"LLM API Error - Endpoint: {endpoint}, Status: {response.status_code}, Response: {body}")
+                raise HTTPException(status_code=response.status_code, detail=f"{response.status_code}: {body}")
+
+            async for line in response.aiter_lines():
+                line = line.strip()
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                data = json.loads(payload)
+                choices = data.get("choices") or [{}]
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    yield delta
+    else:
+        # Ollama，返回 NDJSON: 每行一个 {"message": {...}, "done": ...}
+        async with client.stream(
+            "POST",
+            f"{ollama_host}/api/chat",
+            json={
+                "model": llm_model,
+                "messages": messages,
+                "stream": True
+            },
+            timeout=60.0
+        ) as response:
+            if response.status_code != 200:
+                body = (await response.aread()).decode("utf-8", errors="replace")
+                raise HTTPException(status_code=response.status_code, detail=f"Ollama API 错误: {body}")
+
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                delta = data.get("message", {}).get("content")
+                if delta:
+                    yield delta
+                if data.get("done"):
+                    break
+
+
+async def _run_speculative_execution(
+    code: str,
+    file_path: Optional[str],
+    previous: List[asyncio.Task]
+) -> Dict[str, Any]:
+    """执行一次预执行，保证同一时间最多只有一个预执行占用执行进程
+
+    先等待之前（已被取消）的预执行全部结束再提交；自身被取消时，已开始的执行无法中断，
+    会等它结束后再退出（等待期间再次收到的取消不会打断等待）。
+    """
+    if previous:
+        await asyncio.wait(previous)
+    pool = get_sandbox_pool()
+    try:
+        future = pool.submit(functools.partial(execute_python_code, code, file_path))
+    except BrokenProcessPool as e:
+        return discard_broken_sandbox_pool(pool, e)
+    wrapped = asyncio.wrap_future(future)
+    try:
+        return await asyncio.shield(wrapped)
+    except BrokenProcessPool as e:
+        return discard_broken_sandbox_pool(pool, e)
+    except asyncio.CancelledError:
+        if not future.cancel():
+            while not wrapped.done():
+                try:
+                    await asyncio.wait([wrapped])
+                except asyncio.CancelledError:
+                    continue
+            if not wrapped.cancelled() and isinstance(wrapped.exception(), BrokenProcessPool):
+                discard_broken_sandbox_pool(pool, wrapped.exception())
+        raise
+
+
+async def collect_with_speculative_execution(
+    deltas: AsyncIterator[str],
+    file_path: Optional[str] = None
+) -> Tuple[str, Optional[Tuple[str, Dict[str, Any]]]]:
+    """消费 LLM 流式输出，代码块一闭合就提交到执行进程池，与剩余的生成过程并行
+
+    如果之后又生成了新的代码块，则取消之前的预执行，将所有代码块合并后重新执行（与非流式处理的合并规则一致）。
+    返回完整的响应文本和 (预执行的代码, 执行结果)。
+    """
+    parser = StreamingCodeBlockParser()
+    speculative_code = None
+    tasks: List[asyncio.Task] = []
+
+    try:
+        async for delta in deltas:
+            if not parser.feed(delta):
+                continue
+
+            # 有新的代码块闭合，取消过期的预执行，按合并后的完整代码重新预执行
+            previous = [task for task in tasks if not task.done()]
+            for task in previous:
+                task.cancel()
+            speculative_code = "\n\n".join(parser.blocks)
+            print(f"\n[预执行] 检测到第 {len(parser.blocks)} 个已闭合的代码块，提交执行...")
+            tasks.append(asyncio.ensure_future(
+                _run_speculative_execution(speculative_code, file_path, previous)
+            ))
+
+        if not tasks:
+            return parser.buffer, None
+
+        result = await tasks[-1]
+        return parser.buffer, (speculative_code, result)
+    finally:
+        # 流式输出中途出错时取消所有预执行，并等待已开始的执行结束
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def format_profile_summary(profile: Dict[str, Any]) -> str:
+    """把性能分析结果格式化为发给 LLM 的文本"""
+    text = f"耗时（开启性能分析时）: {profile['duration']:.2f}s，内存峰值: {profile['peak_memory_mb']} MB\n"
+    if profile.get("anti_patterns"):
+        text += "\n检测到的 pandas 低效写法:\n"
+        text += "\n".join(f"- {finding}" for finding in profile["anti_patterns"]) + "\n"
+    if profile.get("hotspots"):
+        text += f"\ncProfile 热点（按累计耗时排序）:\n{profile['hotspots'][:3000]}\n"
+    return text
+
+
+async def optimize_slow_code(
+    code: str,
+    result: Dict[str, Any],
+    file_path: Optional[str] = None,
+    llm_api_base: str = None,
+    llm_api_key: str = None,
+    llm_model: str = None,
+    ollama_host: str = None
+) -> Tuple[str, Dict[str, Any], Optional[str]]:
+    """让 LLM 根据性能分析结果改写为向量化代码，输出和图表一致且更快时采用改写版本
+
+    result 是未开启性能分析的执行结果；cProfile 会明显拖慢逐行调用多的代码，
+    所以耗时比较只使用未开启分析的执行，分析结果只用于给 LLM 提供热点信息。
+    返回 (采用的代码, 采用的执行结果, 优化说明)，未采用改写版本时优化说明为 None。
+    """
+    print(f"\n[性能] 代码耗时 {result['duration']:.2f}s，开启性能分析重新执行以定位热点...")
+    profiled_result = await run_in_sandbox(execute_python_code, code, file_path, profile=True)
+    profile = profiled_result.get("profile") or {
+        "duration": result["duration"],
+        "peak_memory_mb": 0,
+        "hotspots": "",
+        "anti_patterns": detect_pandas_anti_patterns(code)
+    }
+    print(f"[性能] 请求 LLM 改写为向量化版本...")
+    
+    rewrite_request = "下面的 Python 代码运行太慢，请在保证输出完全一致（打印内容、格式和顺序都相同）的前提下，"
+    rewrite_request += "改写为使用 pandas/numpy 向量化运算的版本，避免逐行遍历、按行 apply 和在循环中重复读取文件。\n\n"
+    rewrite_request += f"```python\n{code}\n```\n\n**性能分析结果:**\n```\n{format_profile_summary(profile)}```\n\n"
+    rewrite_request += "请只返回一个完整的 Python 代码块（所有代码放在一个 ```python ... ``` 块中）。"
+    
+    try:
+        content = await request_llm_completion(
+            [
+                {"role": "system", "content": SYSTEM_INSTRUCTION},
+                {"role": "user", "content": rewrite_request}
+            ],
+            llm_api_base,
+            llm_api_key,
+            llm_model,
+            ollama_host,
+            timeout=600.0
+        )
+    except Exception as e:
+        print(f"[性能] LLM 改写失败，保留原代码: {str(e)}")
+        return code, result, None
+    
+    code_blocks = extract_code_blocks(content)
+    if not code_blocks:
+        print(f"[性能] LLM 未返回代码块，保留原代码")
+        return code, result, None
+    rewritten_code = "\n\n".join(code_blocks)
+    
+    rewritten_result = await run_in_sandbox(execute_python_code, rewritten_code, file_path)
+    if not rewritten_result["success"]:
+        print(f"[性能] 改写后的代码执行失败，保留原代码: {rewritten_result.get('error')}")
+        return code, result, None
+    if (rewritten_result.get("output"), rewritten_result.get("result")) != (result.get("output"), result.get("result")):
+        print(f"[性能] 改写后的代码输出不一致，保留原代码")
+        return code, result, None
+    # 图片按内容哈希命名，URL 相同即图表内容相同
+    if rewritten_result.get("images", []) != result.get("images", []):
+        print(f"[性能] 改写后的代码生成的图表不一致，保留原代码")
+        return code, result, None
+    
+    # 两次执行都未开启性能分析，耗时可以直接比较
+    if rewritten_result["duration"] >= result["duration"]:
+        print(f"[性能] 改写后的代码没有更快 ({rewritten_result['duration']:.2f}s)，保留原代码")
+        return code, result, None
+    
+    print(f"[性能] 采用改写后的代码: {result['duration']:.2f}s -> {rewritten_result['duration']:.2f}s")
+    note = f"\n**性能优化:** 代码耗时 {result['duration']:.2f}s，已自动改写为向量化版本（输出和图表一致），耗时降至 {rewritten_result['duration']:.2f}s：\n"
+    note += f"\n```python\n{rewritten_code}\n```\n"
+    return rewritten_code, rewritten_result, note
+
+
 async def process_llm_response_with_code_execution(
     response_content: str,
     file_path: Optional[str] = None,
@@ -426,9 +1393,15 @@ async def process_llm_response_with_code_execution(
     llm_api_key: str = None,
     llm_model: str = None,
     ollama_host: str = None,
-    max_iterations: int = 5
+    max_iterations: int = 5,
+    speculative: Optional[Tuple[str, Dict[str, Any]]] = None,
+    profile_threshold: Optional[float] = None
 ) -> str:
-    """处理 LLM 响应，执行其中的代码块，如果出错则反馈给 LLM 修复"""
+    """处理 LLM 响应，执行其中的代码块，如果出错则反馈给 LLM 修复
+
+    speculative 为流式生成期间已经预执行的 (代码, 执行结果)，代码一致时直接复用结果。
+    profile_threshold 不为 None 时，执行耗时超过该秒数则开启性能分析定位热点，并请求 LLM 改写为向量化版本。
+    """
     current_content = response_content
     iteration = 0
     all_execution_results = []  # 保存所有执行结果
@@ -469,10 +1442,13 @@ async def process_llm_response_with_code_execution(
         
         # 执行完整的代码块（只有一个）
         code = code_blocks[0]
-        print(f"[执行] 执行完整代码块...")
-        result = execute_python_code(code, file_path)
-        execution_results = [result]
-        all_execution_results.append(result)
+        if speculative and speculative[0] == code:
+            print(f"[执行] 复用流式生成期间的预执行结果")
+            result = speculative[1]
+        else:
+            print(f"[执行] 执行完整代码块...")
+            result = await run_in_sandbox(execute_python_code, code, file_path)
+        speculative = None  # 预执行结果只对首次响应有效
         
         if result["success"]:
             print(f"  ✓ 执行成功")
@@ -482,6 +1458,15 @@ async def process_llm_response_with_code_execution(
         else:
             print(f"  ✗ 执行失败: {result.get('error', 'Unknown error')}")
         
+        # 执行太慢时尝试让 LLM 改写为向量化版本
+        optimization_note = None
+        if result["success"] and profile_threshold is not None and result.get("duration", 0) > profile_threshold:
+            code, result, optimization_note = await optimize_slow_code(
+                code, result, file_path, llm_api_base, llm_api_key, llm_model, ollama_host
+            )
+        execution_results = [result]
+        all_execution_results.append(result)
+        
         # 如果代码执行成功，将结果添加到响应中
         if result["success"]:
             results_text = "\n\n**代码执行结果:**\n"
@@ -497,6 +1482,9 @@ async def process_llm_response_with_code_execution(
                 for img_url in result["images"]:
                     results_text += f"\n![生成的图表]({img_url})\n"
             
+            if optimization_note:
+                results_text += optimization_note
+            
             current_content += results_text
             return current_content
         else:
@@ -536,15 +1524,7 @@ async def process_llm_response_with_code_execution(
                 if llm_api_base and llm_api_key:
                     # 使用自定义 LLM API
                     async with httpx.AsyncClient() as client:
-                        endpoint = llm_api_base.rstrip('/')
-                        if endpoint.endswith('/chat/completions'):
-                            pass
-                        elif endpoint.endswith('/v1'):
-                            endpoint = endpoint + '/chat/completions'
-                        elif '/v1/' in endpoint:
-                            endpoint = endpoint.rstrip('/') + '/chat/completions'
-                        else:
-                            endpoint = endpoint + '/v1/chat/completions'
+                        endpoint = build_chat_completions_endpoint(llm_api_base)
                         
                         response = await client.post(
                             endpoint,
@@ -623,6 +1603,102 @@ async def process_llm_response_with_code_execution(
     return current_content
 
 
+async def request_llm_completion(
+    messages: List[Dict[str, str]],
+    llm_api_base: str = None,
+    llm_api_key: str = None,
+    llm_model: str = None,
+    ollama_host: str = None,
+    timeout: float = 60.0
+) -> str:
+    """以非流式方式调用 LLM，返回生成的完整文本"""
+    async with httpx.AsyncClient() as client:
+        if llm_api_base and llm_api_key:
+            # 使用自定义 LLM API (OpenAI/vLLM 兼容)
+            endpoint = build_chat_completions_endpoint(llm_api_base)
+            response = await client.post(
+                endpoint,
+                headers={
+                    "Authorization": f"Bearer {llm_api_key}",
+                    "Content-Type": "application/json"
+                },
+                json={
+                    "model": llm_model,
+                    "messages": messages
+                },
+                timeout=timeout
+            )
+            if response.status_code != 200:
+                print(f"LLM API Error - Endpoint: {endpoint}, Status: {response.status_code}, Response: {response.text}")
+                raise HTTPException(status_code=response.status_code, detail=f"{response.status_code}: {response.text}")
+            data = response.json()
+            return data.get("choices", [{}])[0].get("message", {}).get("content", "")
+
+        # 使用 Ollama
+        response = await client.post(
+            f"{ollama_host}/api/chat",
+            json={
+                "model": llm_model,
+                "messages": messages,
+                "stream": False
+            },
+            timeout=timeout
+        )
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, detail=f"Ollama API 错误: {response.text}")
+        data = response.json()
+        return data.get("message", {}).get("content", "")
+
+
+def summarize_execution_result(result: Dict[str, Any]) -> str:
+    """提取执行结果的一行摘要（最后一个表达式的值、最后一行输出或错误信息的最后一行），可直接放入 Markdown 表格"""
+    if not result.get("success"):
+        text = result.get("error") or "Unknown error"
+    elif result.get("result"):
+        text = result["result"]
+    else:
+        lines = [line.strip() for line in (result.get("output") or "").splitlines() if line.strip()]
+        text = lines[-1] if lines else ""
+    text = text.strip().splitlines()[-1] if text.strip() else ""
+    # 先截断再转义，避免截断在转义符中间
+    return text[:200].replace("|", "\\|")
+
+
+def build_batch_summary_table(rows: List[Dict[str, Any]]) -> str:
+    """将批量执行的结果汇总为 Markdown 表格"""
+    table = "| 文件 | 状态 | 耗时 (s) | 结果 |\n"
+    table += "| --- | --- | --- | --- |\n"
+    for row in rows:
+        status = "✓" if row["success"] else "✗"
+        filename = row['filename'].replace("|", "\\|")
+        table += f"| {filename} | {status} | {row['duration']:.2f} | {row['summary']} |\n"
+    return table
+
+
+@app.on_event("startup")
+async def warm_up_sandbox():
+    """后台启动代码执行进程，不阻塞 API 启动和健康检查
+
+    进程池按需创建进程，提交空任务只是为了提前启动进程；数据分析库由进程池的 initializer 加载。
+    """
+    pool = get_sandbox_pool()
+    for _ in range(SANDBOX_WORKERS):
+        pool.submit(os.getpid)
+
+
+@app.on_event("shutdown")
+async def shutdown_sandbox():
+    """关闭代码执行进程池，避免 --reload 或容器停止后遗留执行进程"""
+    global _sandbox_pool
+    if _sandbox_pool is not None:
+        _sandbox_pool.shutdown(wait=False, cancel_futures=True)
+        _sandbox_pool = None
+    global _query_executor
+    if _query_executor is not None:
+        _query_executor.shutdown(wait=False, cancel_futures=True)
+        _query_executor = None
+
+
 @app.get("/")
 async def root():
     return {"message": "CloudOS AI Backend API", "status": "running"}
@@ -652,6 +1728,22 @@ async def upload_file(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"文件上传失败: {str(e)}")
 
 
+@app.post("/query")
+async def query(request: QueryRequest):
+    """直接在上传文件上执行只读 SQL 查询，不调用 LLM"""
+    if request.filenames is not None:
+        for filename in request.filenames:
+            if os.path.basename(filename) != filename or not os.path.exists(os.path.join(UPLOAD_DIR, filename)):
+                raise HTTPException(status_code=404, detail=f"文件不存在: {filename}")
+    
+    limit = max(1, min(request.limit, SQL_MAX_ROWS))
+    await prepare_excel_copies(await run_in_query_thread(referenced_uploads, request.sql, request.filenames))
+    result = await run_in_query_thread(run_sql_query, request.sql, request.filenames, limit)
+    if not result["success"]:
+        raise HTTPException(status_code=400, detail=f"SQL 查询失败: {result['error']}")
+    return result
+
+
 @app.post("/chat")
 async def chat(request: ChatRequest):
     """处理聊天请求 - 支持代码执行的文件分析"""
@@ -662,6 +1754,11 @@ async def chat(request: ChatRequest):
         llm_model = os.getenv("LLM_MODEL", "gemini-pro")
         ollama_host = os.getenv("OLLAMA_HOST", "http://host.docker.internal:11434")
         
+        # 性能分析（可选）：执行耗时超过阈值时请求 LLM 改写为向量化版本
+        profile_threshold = None
+        if os.getenv("PROFILE_EXECUTION", "false").lower() in ("1", "true", "yes"):
+            profile_threshold = float(os.getenv("PROFILE_THRESHOLD_SECONDS", "5"))
+        
         # 获取文件路径（如果提供了文件名）
         file_path = None
         if request.filename:
@@ -669,12 +1766,26 @@ async def chat(request: ChatRequest):
             if not os.path.exists(file_path):
                 file_path = None
         
-        # 构建消息（创建副本，避免修改原始数据）
-        messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+        # 快速查询路由：简单的结构化问题直接用 SQL 引擎回答，跳过 LLM
+        if file_path and request.messages and os.getenv("FAST_QUERY_ROUTER", "false").lower() in ("1", "true", "yes"):
+            spec = match_structured_question(request.messages[-1].content)
+            if spec:
+                await prepare_excel_copies([request.filename])
+                answer = await run_in_query_thread(answer_structured_question, spec, request.filename)
+                if answer["success"]:
+                    print(f"[快速查询] {answer['sql']} ({answer['duration'] * 1000:.1f}ms)")
+                    return {"role": "assistant", "content": format_sql_answer(answer)}
+                print(f"[快速查询] 无法直接回答，回退到 LLM: {answer['error']}")
+        
+        # 构建消息（创建副本，避免修改原始数据），历史回复中的 HTML 报告链接还原为源码
+        messages = [
+            {"role": msg.role, "content": await run_in_thread(expand_html_reports, msg.content) if msg.role == "assistant" else msg.content}
+            for msg in request.messages
+        ]
         
         # 如果有文件，告诉大模型文件路径（而不是读取内容）
         if file_path and messages:
-            file_info = f"\n\n**已上传文件信息:**\n- 文件名: {os.path.basename(file_path)}\n- 文件路径: {file_path}\n- 文件大小: {os.path.getsize(file_path)} bytes\n\n你可以编写 Python 代码来读取和分析这个文件。例如使用 pandas 读取 Excel/CSV，或使用 pdfplumber 读取 PDF。"
+            file_info = f"\n\n**已上传文件信息:**\n- 文件名: {os.path.basename(file_path)}\n- 文件路径: {file_path}\n- 文件大小: {os.path.getsize(file_path)} bytes\n- SQL 表名: {sql_table_name(file_path)}\n\n你可以编写 Python 代码来读取和分析这个文件。例如使用 pandas 读取 Excel/CSV，或使用 pdfplumber 读取 PDF，也可以用 sql() 直接查询。"
             messages[-1] = {"role": messages[-1]["role"], "content": messages[-1]["content"] + file_info}
         
         # 添加系统提示（如果是第一条消息）
@@ -684,24 +1795,43 @@ async def chat(request: ChatRequest):
         # 保存原始消息列表的副本，用于代码执行错误反馈
         messages_for_code_execution = messages.copy()
         
+        # 流式调用 LLM，代码块一闭合就开始执行，与剩余文本的生成并行
+        if os.getenv("SPECULATIVE_EXECUTION", "true").lower() in ("1", "true", "yes"):
+            use_custom_api = bool(llm_api_base and llm_api_key)
+            async with httpx.AsyncClient() as client:
+                content, speculative = await collect_with_speculative_execution(
+                    stream_llm_completion(
+                        client,
+                        messages,
+                        llm_api_base if use_custom_api else None,
+                        llm_api_key if use_custom_api else None,
+                        llm_model,
+                        None if use_custom_api else ollama_host
+                    ),
+                    file_path
+                )
+            
+            # 处理代码执行（支持错误反馈循环）
+            final_content = await process_llm_response_with_code_execution(
+                content,
+                file_path,
+                messages_for_code_execution,
+                llm_api_base if use_custom_api else None,
+                llm_api_key if use_custom_api else None,
+                llm_model,
+                None if use_custom_api else ollama_host,
+                speculative=speculative,
+                profile_threshold=profile_threshold
+            )
+            
+            return {"role": "assistant", "content": await run_in_thread(publish_html_reports, final_content)}
+        
         # 如果配置了自定义 LLM API，使用自定义 API
         if llm_api_base and llm_api_key:
             # 使用自定义 LLM API (OpenAI/vLLM 兼容)
             async with httpx.AsyncClient() as client:
                 # 构建 endpoint URL
-                endpoint = llm_api_base.rstrip('/')
-                if endpoint.endswith('/chat/completions'):
-                    # 已经包含完整路径
-                    pass
-                elif endpoint.endswith('/v1'):
-                    # 已经包含 /v1，只需添加 /chat/completions
-                    endpoint = endpoint + '/chat/completions'
-                elif '/v1/' in endpoint:
-                    # 包含 /v1/，添加 chat/completions
-                    endpoint = endpoint.rstrip('/') + '/chat/completions'
-                else:
-                    # 不包含 /v1，添加 /v1/chat/completions
-                    endpoint = endpoint + '/v1/chat/completions'
+                endpoint = build_chat_completions_endpoint(llm_api_base)
                 
                 response = await client.post(
                     endpoint,
@@ -728,10 +1858,11 @@ async def chat(request: ChatRequest):
                         llm_api_base,
                         llm_api_key,
                         llm_model,
-                        None  # ollama_host not used for custom API
+                        None,  # ollama_host not used for custom API
+                        profile_threshold=profile_threshold
                     )
                     
-                    return {"role": "assistant", "content": final_content}
+                    return {"role": "assistant", "content": await run_in_thread(publish_html_reports, final_content)}
                 else:
                     error_detail = f"{response.status_code}: {response.text}"
                     print(f"LLM API Error - Endpoint: {endpoint}, Status: {response.status_code}, Response: {response.text}")
@@ -761,10 +1892,11 @@ async def chat(request: ChatRequest):
                     None,  # llm_api_base not used for Ollama
                     None,  # llm_api_key not used for Ollama
                     llm_model,
-                    ollama_host
+                    ollama_host,
+                    profile_threshold=profile_threshold
                 )
                 
-                return {"role": "assistant", "content": final_content}
+                return {"role": "assistant", "content": await run_in_thread(publish_html_reports, final_content)}
             else:
                 raise HTTPException(
                     status_code=response.status_code,
@@ -777,6 +1909,109 @@ async def chat(request: ChatRequest):
         raise HTTPException(status_code=500, detail=f"处理请求时出错: {str(e)}")
 
 
+@app.post("/batch")
+async def batch(request: BatchRequest):
+    """批量分析 - LLM 只生成一次通用脚本，在执行进程池中并行处理多个上传文件
+
+    以 NDJSON 流式返回：先返回生成的脚本，然后每个文件完成时返回一条结果，最后返回汇总表格。
+    """
+    if not request.filenames:
+        raise HTTPException(status_code=400, detail="未提供需要分析的文件")
+    
+    file_paths = []
+    for filename in request.filenames:
+        file_path = os.path.join(UPLOAD_DIR, filename)
+        if os.path.basename(filename) != filename or not os.path.exists(file_path):
+            raise HTTPException(status_code=404, detail=f"文件不存在: {filename}")
+        file_paths.append(file_path)
+    
+    # 并发数不超过执行进程池的大小，避免批量任务占满队列
+    concurrency = max(1, min(request.max_concurrency or SANDBOX_WORKERS, SANDBOX_WORKERS))
+    
+    try:
+        # 从环境变量读取 LLM 配置（在 Docker 中配置）
+        llm_api_base = os.getenv("LLM_API_BASE")
+        llm_api_key = os.getenv("LLM_API_KEY")
+        llm_model = os.getenv("LLM_MODEL", "gemini-pro")
+        ollama_host = os.getenv("OLLAMA_HOST", "http://host.docker.internal:11434")
+        use_custom_api = bool(llm_api_base and llm_api_key)
+        
+        # 以第一个文件作为样例，告诉大模型文件信息
+        sample_path = file_paths[0]
+        file_list = "\n".join(f"- {filename}" for filename in request.filenames)
+        file_info = f"\n\n**批量分析文件 ({len(file_paths)} 个):**\n{file_list}\n\n**样例文件:**\n- 文件路径: {sample_path}\n- 文件大小: {os.path.getsize(sample_path)} bytes\n\n请编写一个通用的 Python 脚本，通过变量 `file_path` 读取当前处理的文件。"
+        messages = [
+            {"role": "system", "content": SYSTEM_INSTRUCTION + BATCH_INSTRUCTION},
+            {"role": "user", "content": request.prompt + file_info}
+        ]
+        
+        print(f"\n[批量] 调用 LLM 生成通用脚本，共 {len(file_paths)} 个文件，并发数 {concurrency}...")
+        content = await request_llm_completion(
+            messages,
+            llm_api_base if use_custom_api else None,
+            llm_api_key if use_custom_api else None,
+            llm_model,
+            None if use_custom_api else ollama_host
+        )
+    except HTTPException:
+        raise
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=503, detail=f"无法连接到 LLM 服务: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"处理请求时出错: {str(e)}")
+    
+    code_blocks = extract_code_blocks(content)
+    if not code_blocks:
+        raise HTTPException(status_code=502, detail="LLM 未返回可执行的 Python 代码块")
+    code = "\n\n".join(code_blocks)
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def run_one(index: int, filename: str, file_path: str) -> Dict[str, Any]:
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                result = await run_in_sandbox(execute_python_code, code, file_path)
+            except Exception as e:
+                result = {"success": False, "error": str(e), "traceback": traceback.format_exc()}
+            return {"index": index, "filename": filename, "duration": time.perf_counter() - start, **result}
+    
+    async def event_stream():
+        yield json.dumps({"type": "script", "content": content, "code": code}, ensure_ascii=False) + "\n"
+        
+        tasks = [asyncio.ensure_future(run_one(index, filename, file_path))
+                 for index, (filename, file_path) in enumerate(zip(request.filenames, file_paths))]
+        rows = {}
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                status = "✓" if item["success"] else "✗"
+                print(f"  {status} [批量] {item['filename']} ({item['duration']:.2f}s)")
+                rows[item["index"]] = {
+                    "filename": item["filename"],
+                    "success": item["success"],
+                    "duration": item["duration"],
+                    "summary": summarize_execution_result(item)
+                }
+                yield json.dumps({"type": "result", **item}, ensure_ascii=False) + "\n"
+        finally:
+            # 客户端断开时取消尚未开始的任务
+            for task in tasks:
+                task.cancel()
+        
+        # 汇总表格按请求中的文件顺序排列
+        ordered_rows = [rows[index] for index in sorted(rows)]
+        succeeded = sum(1 for row in ordered_rows if row["success"])
+        yield json.dumps({
+            "type": "summary",
+            "succeeded": succeeded,
+            "failed": len(ordered_rows) - succeeded,
+            "table": build_batch_summary_table(ordered_rows)
+        }, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -58,16 +58,30 @@ const CodeBlock: React.FC<{ language: string; value: string }> = ({ language, va
   );
 };
 
-const HtmlPreviewBlock: React.FC<{ value: string }> = ({ value }) => {
+// url 为后端保存的 HTML 报告地址（内容哈希命名，浏览器可长期缓存），源码在查看源代码或复制时才下载
+const HtmlPreviewBlock: React.FC<{ value?: string; url?: string }> = ({ value, url }) => {
   const [copied, setCopied] = useState(false);
   const [showPreview, setShowPreview] = useState(true);
+  const [source, setSource] = useState<string | undefined>(value);
 
-  const handleCopy = () => {
-    navigator.clipboard.writeText(value);
+  const loadSource = async (): Promise<string> => {
+    if (source !== undefined) return source;
+    const text = url ? await (await fetch(url)).text() : '';
+    setSource(text);
+    return text;
+  };
+
+  const handleCopy = async () => {
+    navigator.clipboard.writeText(await loadSource());
     setCopied(true);
     setTimeout(() => setCopied(false), 2000);
   };
 
+  const handleToggle = () => {
+    if (showPreview) loadSource();
+    setShowPreview(!showPreview);
+  };
+
   // 确保 HTML 内容完整（如果没有 html/head/body 标签，自动包装）
   const getFullHtml = (html: string): string => {
     const trimmed = html.trim();
@@ -102,7 +116,7 @@ ${trimmed}
         <span className="text-xs font-mono text-slate-400 lowercase">html</span>
         <div className="flex items-center gap-2">
           <button
-            onClick={() => setShowPreview(!showPreview)}
+            onClick={handleToggle}
             className="flex items-center gap-1.5 text-xs text-slate-400 hover:text-white transition"
             title={showPreview ? '查看源代码' : '预览 HTML'}
           >
@@ -121,7 +135,8 @@ ${trimmed}
       {showPreview ? (
         <div className="w-full bg-white border-t border-slate-700" style={{ minHeight: '300px', maxHeight: '600px', overflow: 'auto' }}>
           <iframe
-            srcDoc={getFullHtml(value)}
+            src={url}
+            srcDoc={url ? undefined : getFullHtml(source || '')}
             className="w-full border-0"
             style={{ minHeight: '300px', height: '100%', width: '100%' }}
             sandbox="allow-same-origin allow-scripts allow-forms allow-popups"
@@ -131,7 +146,7 @@ ${trimmed}
       ) : (
         <div className="p-4 overflow-x-auto">
           <pre className="font-mono text-sm text-slate-300 leading-relaxed whitespace-pre">
-            <code>{value}</code>
+            <code>{source ?? '加载中...'}</code>
           </pre>
         </div>
       )}
@@ -185,6 +200,10 @@ const MessageRenderer: React.FC<{ text: string; backendUrl?: string }> = ({ text
             if (url.startsWith('/static')) {
               url = `${backendUrl}${url}`;
             }
+            // 后端保存为静态文件的 HTML 报告
+            if (url.endsWith('.html')) {
+              return <HtmlPreviewBlock key={index} url={url} />;
+            }
             return (
               <div key={index} className="my-2 rounded-lg overflow-hidden border border-slate-200 dark:border-slate-700 bg-white dark:bg-black">
                 <img src={url} alt={imageMatch[1]} className="max-w-full h-auto" />